@@ -26,7 +26,12 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 # Naive database setup
-connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+# Atlas needs TLS. A local replica set (see setup.txt) usually doesn't so you can
+# turn it off by putting 'MONGO_TLS': False in secrets.py
+if secrets.get('MONGO_TLS', True):
+    connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+else:
+    connect(secrets['MONGO_DB_NAME'], host=secrets['MONGO_HOST'])
 moment = Moment(app)
 
 def base64encode(img):
@@ -0,0 +1,309 @@
+# These are async versions of the busiest pages: the blog and animal lists, a single
+# blog or animal, and the Google login callback. The normal routes in app/routes wait
+# for MongoDB and Google while holding a whole worker thread. These use Motor (async
+# MongoDB) and httpx (async HTTP) so one worker can wait on hundreds of requests at once,
+# and they ask for things that don't depend on each other at the same time.
+#
+# The live comment streams are here too. Under Flask each open stream keeps a thread
+# busy for as long as the page is open. Here it is just a coroutine waiting on a queue.
+#
+# They only run when the site is started as an ASGI app with asgi.py. The paths are the
+# same as the Flask routes, so asgi.py sends these paths here and everything else to
+# Flask. When the site is started with main.py or gunicorn.conf.py the Flask routes are
+# used like before.
+#
+# The pages are still drawn with the Flask templates. Each request opens a Flask request
+# context so current_user, session, flash and url_for work in the templates like normal.
+
+import asyncio
+import json
+import httpx
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from flask import g, session, request as flaskRequest, render_template, redirect, url_for, flash
+from flask.globals import _request_ctx_stack
+from flask_login import login_user
+from starlette.convertors import Convertor, register_url_convertor
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from app import app, login_manager
+from app.classes.data import User, Blog, Animal, Comment, APPROVED, nameKey
+from app.routes.login import client, secrets, unauthorized
+from app.utils.asyncdb import asyncCollection, asyncCausalSession
+from app.utils.commentstream import commentStream, AsyncSubscriber, sseMessage, HEARTBEAT_SECONDS
+from app.utils.readrouting import storeLastWrite
+from app.utils.userdirectory import clearUserDirectory
+
+
+# '{blogID:objectid}' in a path only matches a real MongoDB id, so /blog/new and
+# /animal/new still go to Flask.
+class ObjectIDConvertor(Convertor):
+    regex = '[0-9a-fA-F]{24}'
+
+    def convert(self, value):
+        return ObjectId(value)
+
+    def to_string(self, value):
+        return str(value)
+
+register_url_convertor('objectid', ObjectIDConvertor())
+
+
+def flaskContext(request):
+    return app.test_request_context(
+        request.url.path,
+        base_url='{}://{}'.format(request.url.scheme, request.url.netloc),
+        query_string=request.url.query,
+        method=request.method,
+        headers=list(request.headers.items()),
+        # flask_login's session protection uses the address of the browser
+        environ_base={'REMOTE_ADDR': request.client.host if request.client else None},
+    )
+
+
+# This turns the Flask response into a Starlette one. process_response saves the
+# session (flash messages, login) into the cookie like Flask normally does.
+def asgiResponse(flaskResponse):
+    flaskResponse = app.process_response(app.make_response(flaskResponse))
+    response = Response(flaskResponse.get_data(), status_code=flaskResponse.status_code)
+    response.raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in flaskResponse.headers.items()]
+    return response
+
+
+# This does what flask_login does when it loads current_user, but reads the user with
+# Motor so it doesn't block. It has to run before anything uses current_user.
+# It does the session protection check like flask_login. It doesn't look at the
+# "remember me" cookie because this site never sets one (login_user is called without
+# remember=True).
+async def loadCurrentUser():
+    userID = session.get('_user_id')
+    user = None
+    # In 'strong' mode this logs the user out if the session cookie came from a
+    # different browser or address than the one that logged in.
+    if login_manager._session_protection_failed():
+        userID = None
+    if userID and ObjectId.is_valid(userID):
+        async with await asyncCausalSession() as clientSession:
+            son = await asyncCollection(User).find_one({'_id': ObjectId(userID)}, session=clientSession)
+        if son is not None:
+            user = User._from_son(son)
+    _request_ctx_stack.top.user = user if user is not None else login_manager.anonymous_user()
+    return user
+
+
+# $lookup puts the author into each blog, animal or comment in the same query
+def lookupAuthor(authorField):
+    return {'$lookup': {
+        'from': User._get_collection_name(),
+        'localField': authorField,
+        'foreignField': '_id',
+        'as': authorField,
+    }}
+
+
+# This makes a mongoengine object out of a query result that used lookupAuthor().
+# The author is already there so the template doesn't need to go back to the database.
+def fromSon(document, son, authorField):
+    authors = son.pop(authorField, None) or []
+    thisDocument = document._from_son(son)
+    if authors:
+        setattr(thisDocument, authorField, User._from_son(authors[0]))
+    return thisDocument
+
+
+async def postList(request, document, authorField, approvalField, dateField, template, name):
+    with flaskContext(request):
+        g.staleReadsOK = True
+        if await loadCurrentUser() is None:
+            return asgiResponse(unauthorized())
+        pipeline = []
+        approvedOnly = flaskRequest.args.get('approved') == '1'
+        if approvedOnly:
+            pipeline.append({'$match': {approvalField: APPROVED}})
+            pipeline.append({'$sort': {dateField: -1}})
+        pipeline.append(lookupAuthor(authorField))
+        async with await asyncCausalSession() as clientSession:
+            sons = await asyncCollection(document).aggregate(pipeline, session=clientSession).to_list(None)
+        posts = [fromSon(document, son, authorField) for son in sons]
+        return asgiResponse(render_template(template, approvedOnly=approvedOnly, **{name: posts}))
+
+
+async def postWithComments(request, document, authorField, commentField, template):
+    postID = request.path_params['postID']
+    with flaskContext(request):
+        g.staleReadsOK = True
+        if await loadCurrentUser() is None:
+            return asgiResponse(unauthorized())
+        # The post and its comments don't depend on each other so ask for both at once.
+        # Each one brings its authors with it.
+        async with await asyncCausalSession() as postSession, await asyncCausalSession() as commentSession:
+            posts, comments = await asyncio.gather(
+                asyncCollection(document).aggregate([{'$match': {'_id': postID}}, lookupAuthor(authorField)], session=postSession).to_list(None),
+                asyncCollection(Comment).aggregate([{'$match': {commentField: postID}}, lookupAuthor('author')], session=commentSession).to_list(None),
+            )
+        post = fromSon(document, posts[0], authorField) if posts else None
+        comments = [fromSon(Comment, son, 'author') for son in comments]
+        return asgiResponse(render_template(template, comments=comments, **{commentField: post}))
+
+
+async def blogList(request):
+    return await postList(request, Blog, 'author', 'approval', 'create_date', 'blogs.html', 'blogs')
+
+async def blog(request):
+    return await postWithComments(request, Blog, 'author', 'blog', 'blog.html')
+
+async def animalList(request):
+    return await postList(request, Animal, 'animalauthor', 'animalapproval', 'animalcreate_date', 'animals.html', 'animals')
+
+async def animal(request):
+    return await postWithComments(request, Animal, 'animalauthor', 'animal', 'animal.html')
+
+
+# This is the async version of commentEvents() in commentstream.py that the blogStream and
+# animalStream Flask routes use.
+async def postStream(request, kind, commentroute):
+    postID = request.path_params['postID']
+    with flaskContext(request):
+        user = await loadCurrentUser()
+        if user is None:
+            return asgiResponse(unauthorized())
+
+    # The comment html depends on who is looking (the edit and delete links) so each one
+    # is drawn in a Flask context for this user.
+    def renderComment(comment):
+        with flaskContext(request):
+            _request_ctx_stack.top.user = user
+            return render_template('includes/_comment.html', comment=comment, commentroute=commentroute)
+
+    async def events():
+        subscriber = AsyncSubscriber()
+        commentStream.subscribe(kind, postID, subscriber)
+        try:
+            # tell the browser to wait 5 seconds before reconnecting if the connection drops
+            yield 'retry: 5000\n\n'
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                if event['op'] == 'delete':
+                    yield sseMessage('delete', event['id'])
+                else:
+                    name = 'new' if event['op'] == 'insert' else 'edit'
+                    yield sseMessage(name, renderComment(event['comment']))
+        finally:
+            # this runs when the browser goes away (Starlette cancels the stream) or when
+            # is_disconnected() sees it first
+            commentStream.unsubscribe(kind, postID, subscriber)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def blogStream(request):
+    return await postStream(request, 'blog', 'comment')
+
+async def animalStream(request):
+    return await postStream(request, 'animal', 'animalcomment')
+
+
+# One HTTP client for the whole worker so connections to Google are reused.
+httpClient = None
+# Google's discovery document hardly ever changes so it is only fetched once.
+googleProviderCfg = None
+
+async def getGoogleProviderCfg():
+    global httpClient, googleProviderCfg
+    if httpClient is None:
+        httpClient = httpx.AsyncClient(timeout=10)
+    if googleProviderCfg is None:
+        response = await httpClient.get(secrets['GOOGLE_DISCOVERY_URL'])
+        googleProviderCfg = response.json()
+    return googleProviderCfg
+
+
+# This is the same as callback() in app/routes/login.py. Read that one for the details.
+async def callback(request):
+    with flaskContext(request):
+        code = flaskRequest.args.get("code")
+        google_provider_cfg = await getGoogleProviderCfg()
+
+        token_url, headers, body = client.prepare_token_request(
+            google_provider_cfg["token_endpoint"],
+            authorization_response=flaskRequest.url,
+            redirect_url=flaskRequest.base_url,
+            code=code,
+        )
+        token_response = await httpClient.post(
+            token_url,
+            headers=headers,
+            content=body,
+            auth=(secrets['GOOGLE_CLIENT_ID'], secrets['GOOGLE_CLIENT_SECRET']),
+        )
+        client.parse_request_body_response(json.dumps(token_response.json()))
+
+        uri, headers, body = client.add_token(google_provider_cfg["userinfo_endpoint"])
+        userinfo = (await httpClient.get(uri, headers=headers)).json()
+
+        if userinfo.get("hd") != "ousd.org":
+            flash("You must have an ousd.org email account to access this site.")
+            return asgiResponse(("You must have an ousd.org email account to access this site.", 400))
+        if not userinfo.get("email_verified"):
+            return asgiResponse(("User email not available or not verified by Google.", 400))
+
+        changes = {
+            'gid': userinfo["sub"],
+            'gname': userinfo["name"],
+            'gprofile_pic': userinfo["picture"],
+            'fname': userinfo["given_name"],
+            'lname': userinfo["family_name"],
+            'namekey': nameKey(userinfo["given_name"], userinfo["family_name"]),
+        }
+        # This is what a brand new user looks like. The id is made here so we know it
+        # even though the database doesn't send the new user back.
+        thisUser = User(id=ObjectId(), email=userinfo["email"], **changes)
+        # validate() also runs User.clean() which sets namekey
+        thisUser.validate()
+        newUser = thisUser.to_mongo().to_dict()
+        for field in changes:
+            newUser.pop(field)
+
+        users = asyncCollection(User)
+        async with await asyncCausalSession() as clientSession:
+            # One trip to the database updates the user, or makes them if they are new
+            # (upsert), and sends back what they looked like before. $setOnInsert is
+            # only used when the user is made.
+            update = {'$set': changes, '$setOnInsert': newUser}
+            try:
+                before = await users.find_one_and_update({'email': userinfo["email"]}, update, upsert=True,
+                    return_document=ReturnDocument.BEFORE, session=clientSession)
+            except DuplicateKeyError:
+                # Two logins for the same new user at the same moment both tried to make
+                # them and the other one won. Now they exist so this is a normal update.
+                before = await users.find_one_and_update({'email': userinfo["email"]}, update, upsert=True,
+                    return_document=ReturnDocument.BEFORE, session=clientSession)
+            # the same as rememberWrite() for the sync routes
+            storeLastWrite(clientSession.operation_time, clientSession.cluster_time)
+        if before is None:
+            clearUserDirectory()
+        else:
+            if (before.get('fname'), before.get('lname')) != (changes['fname'], changes['lname']):
+                clearUserDirectory()
+            before.update(changes)
+            thisUser = User._from_son(before)
+
+        login_user(thisUser)
+        return asgiResponse(redirect(url_for("index")))
+
+
+asyncRoutes = [
+    Route('/blog/list', blogList),
+    Route('/blogs', blogList),
+    Route('/blog/{postID:objectid}', blog),
+    Route('/blog/{postID:objectid}/stream', blogStream),
+    Route('/animal/list', animalList),
+    Route('/animals', animalList),
+    Route('/animal/{postID:objectid}', animal),
+    Route('/animal/{postID:objectid}/stream', animalStream),
+    Route('/login/callback', callback),
+]
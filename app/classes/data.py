@@ -20,6 +20,12 @@ import jwt
 from time import time
 from bson.objectid import ObjectId
 
+# These are the values of Blog.approval and Animal.animalapproval. A new post is
+# 'Not Given' until a teacher approves or rejects it on the moderation page.
+APPROVED = 'Given'
+PENDING = 'Not Given'
+REJECTED = 'Rejected'
+
 class User(UserMixin, Document):
     createdate = DateTimeField(defaultdefault=dt.datetime.utcnow)
     gid = StringField(sparse=True, unique=True)
@@ -32,10 +38,23 @@ class User(UserMixin, Document):
     image = FileField()
     prononuns = StringField()
     role=StringField()
+    # 'last first' in lowercase. The user directory searches and sorts on this so it
+    # doesn't matter how someone capitalized their name. Set it with nameKey().
+    namekey = StringField()
 
     meta = {
-        'ordering': ['lname','fname']
+        'ordering': ['lname','fname'],
+        'indexes': ['namekey', ('lname','fname')]
     }
+
+    # clean() is run by mongoengine before save(). update() skips it so routes that
+    # change names with update() need to set namekey themselves.
+    def clean(self):
+        self.namekey = nameKey(self.fname, self.lname)
+
+# This makes the value stored in User.namekey
+def nameKey(fname, lname):
+    return ' '.join((lname or '').lower().split() + (fname or '').lower().split())
     
 class Blog(Document):
     author = ReferenceField('User',reverse_delete_rule=CASCADE) 
@@ -45,9 +64,14 @@ class Blog(Document):
     approval = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    # This goes up by one every time the blog is edited. See matchVersion() below.
+    version = IntField(default=0)
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-createdate'],
+        # This index is used by the teachers' moderation queue to find the blogs
+        # waiting for approval and by the approved-only blog list.
+        'indexes': [('approval', '-create_date')]
     }
 
 class Animal(Document):
@@ -58,9 +82,12 @@ class Animal(Document):
     animalapproval = StringField()
     animalcreate_date = DateTimeField(default=dt.datetime.utcnow)
     animalmodify_date = DateTimeField()
+    version = IntField(default=0)
 
     meta = {
-        'ordering': ['-createdate']
+        'ordering': ['-createdate'],
+        # same as the Blog index above
+        'indexes': [('animalapproval', '-animalcreate_date')]
     }
 
 
@@ -75,7 +102,23 @@ class Comment(Document):
     content = StringField()
     create_date = DateTimeField(default=dt.datetime.utcnow)
     modify_date = DateTimeField()
+    version = IntField(default=0)
 
     meta = {
         'ordering': ['-createdate']
-    }
\ No newline at end of file
+    }
+
+# Edit forms send back the version of the blog, animal or comment they were filled in
+# from. The edit routes only update the document if its version is still the same, so
+# if two people edit at once the second one is told instead of wiping out the first.
+# This returns the query for that. Documents from before versions were added don't
+# have a version at all, which is the same as version 0.
+#     Blog.objects(id=blogID, **matchVersion(form.version.data))
+def matchVersion(version):
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        version = 0
+    if version == 0:
+        return {'version__in': [0, None]}
+    return {'version': version}
\ No newline at end of file
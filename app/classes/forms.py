@@ -6,29 +6,38 @@ from flask_wtf import FlaskForm
 import mongoengine.errors
 from wtforms.validators import URL, Email, DataRequired
 from wtforms.fields.html5 import URLField
-from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, BooleanField
+from wtforms import StringField, SubmitField, TextAreaField, IntegerField, SelectField, FileField, BooleanField, HiddenField
 
 class ProfileForm(FlaskForm):
     fname = StringField('First Name', validators=[DataRequired()])
     lname = StringField('Last Name', validators=[DataRequired()]) 
     image = FileField("Image") 
-    role = SelectField('Role', choices=[("Teacher","Teacher"),("Student","Student")])
     submit = SubmitField('Post')
 
 class BlogForm(FlaskForm):
     subject = StringField('Subject', validators=[DataRequired()])
     content = TextAreaField('Blog', validators=[DataRequired()])
     tag = StringField('Tag', validators=[DataRequired()])
-    approval = SelectField('Approval',choices=[("Given","Given"),("Not Given", "Not Given")],validators=[DataRequired()] )
+    # The version of the blog being edited. form.hidden_tag() puts it on the page.
+    version = HiddenField()
     submit = SubmitField('Blog')
 
 class AnimalForm(FlaskForm):
     animalsubject = StringField('Subject', validators=[DataRequired()])
     animalcontent = TextAreaField('Animal', validators=[DataRequired()])
     animaltag = StringField('Tag', validators=[DataRequired()])
-    animalapproval = SelectField('Approval',choices=[("Given","Given"),("Not Given", "Not Given")],validators=[DataRequired()] )
+    version = HiddenField()
     animalsubmit = SubmitField('Animal')
 
 class CommentForm(FlaskForm):
     content = TextAreaField('Comment', validators=[DataRequired()])
+    version = HiddenField()
     submit = SubmitField('Comment')
+
+
+# The moderation page has a checkbox for every post that is waiting. The checkboxes
+# are plain html inputs because the list of posts changes, so this form only holds
+# the two buttons and the hidden csrf token.
+class ModerationForm(FlaskForm):
+    approve = SubmitField('Approve')
+    reject = SubmitField('Reject')
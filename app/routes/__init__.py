@@ -2,4 +2,6 @@ from .default import *
 from .login import *
 from .forum import *
 from .user import *
-from .animal import *
\ No newline at end of file
+from .animal import *
+from .api import *
+from .moderation import *
\ No newline at end of file
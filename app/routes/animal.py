@@ -1,25 +1,39 @@
 from app import app
+from bson.objectid import ObjectId
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, Response, stream_with_context, request
 from flask_login import current_user
-from app.classes.data import Animal, Comment
+from app.classes.data import Animal, Comment, APPROVED, PENDING, matchVersion
 from app.classes.forms import AnimalForm, CommentForm
+from app.utils.commentstream import commentEvents
+from app.utils.readrouting import staleReadsOK, findDocument, findDocuments, rememberWrite
 from flask_login import login_required
 import datetime as dt
 
 # This is the route to list all animals
 @app.route('/animal/list')
 @app.route('/animals')
+# This page can show animals that are a moment old so it can read from a secondary.
+# See app/utils/readrouting.py
+@staleReadsOK
 # This means the user must be logged in to see this page
 @login_required
 def animalList():
     # This retrieves all of the 'animals' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'animals'.
-    animals = Animal.objects()
+    # findDocuments reads from a secondary that has caught up with this user's own
+    # writes and brings each author along in the same query. See app/utils/readrouting.py
+    # /animals?approved=1 only shows the animals a teacher has approved. This query uses
+    # the same (animalapproval, animalcreate_date) index as the moderation page.
+    approvedOnly = request.args.get('approved') == '1'
+    if approvedOnly:
+        animals = findDocuments(Animal, {'animalapproval': APPROVED}, [('animalcreate_date', -1)], authorField='animalauthor')
+    else:
+        animals = findDocuments(Animal, authorField='animalauthor')
     # This renders (shows to the user) the animals.html template. it also sends the animals object 
     # to the template as a variable named animals.  The template uses a for loop to display
     # each animal.
-    return render_template('animals.html',animals=animals)
+    return render_template('animals.html',animals=animals,approvedOnly=approvedOnly)
 
 # This route will get one specific animal and any comments associated with that animal.  
 # The animalID is a variable that must be passsed as a parameter to the function and 
@@ -27,20 +41,31 @@ def animalList():
 # is called when the user clicks a link on animallist.html template.
 # The angle brackets (<>) indicate a variable. 
 @app.route('/animal/<animalID>')
+@staleReadsOK
 # This route will only run if the user is logged in.
 @login_required
 def animal(animalID):
     # retrieve the animal using the animalID
-    thisAnimal = Animal.objects.get(id=animalID)
+    thisAnimal = findDocument(Animal, {'_id': ObjectId(animalID)}, authorField='animalauthor')
     # If there are no comments the 'comments' object will have the value 'None'. Comments are 
     # related to animals meaning that every comment contains a reference to a animal. In this case
     # there is a field on the comment collection called 'animal' that is a reference the Animal
     # document it is related to.  You can use the animalID to get the animal and then you can use
     # the animal object (thisAnimal in this case) to get all the comments.
-    theseComments = Comment.objects(animal=thisAnimal)
+    theseComments = findDocuments(Comment, {'animal': ObjectId(animalID)}, authorField='author')
     # Send the animal object and the comments object to the 'animal.html' template.
     return render_template('animal.html',animal=thisAnimal, comments=theseComments)
 
+# This route sends live comment changes to the animal page. It works exactly like
+# the blogStream route in forum.py.
+@app.route('/animal/<animalID>/stream')
+@login_required
+def animalStream(animalID):
+    def renderComment(comment):
+        return render_template('includes/_comment.html',comment=comment,commentroute='animalcomment')
+    events = stream_with_context(commentEvents('animal',animalID,renderComment))
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+
 # This route will delete a specific animal.  You can only delete the animal if you are the author.
 # <animalID> is a variable sent to this route by the user who clicked on the trash can in the 
 # template 'animal.html'. 
@@ -56,6 +81,8 @@ def animalDelete(animalID):
     if current_user == deleteAnimal.animalauthor:
         # delete the animal using the delete() method from Mongoengine
         deleteAnimal.delete()
+        # this user just changed something so make sure their next reads see it
+        rememberWrite()
         # send a message to the user that the animal was deleted.
         flash('The Animal was deleted.')
     else:
@@ -94,13 +121,17 @@ def animalNew():
             animalsubject = form.animalsubject.data,
             animalcontent = form.animalcontent.data,
             animaltag = form.animaltag.data,
-            animalapproval = form.animalapproval.data,
+            # every new animal waits in the moderation queue until a teacher approves it
+            animalapproval = PENDING,
             animalauthor = current_user.id,
             # This sets the modifydate to the current datetime.
-            animalmodify_date = dt.datetime.utcnow
+            animalmodify_date = dt.datetime.utcnow()
         )
         # This is a method that saves the data to the mongoDB database.
         newAnimal.save()
+        # Make sure this user's next reads see the new animal even if they go to a
+        # secondary that hasn't copied it yet.
+        rememberWrite()
 
         # Once the new animal is saved, this sends the user to that animal using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -124,25 +155,45 @@ def animalNew():
 @app.route('/animal/edit/<animalID>', methods=['GET', 'POST'])
 @login_required
 def animalEdit(animalID):
-    editAnimal = Animal.objects.get(id=animalID)
-    # if the user that requested to edit this animal is not the author then deny them and
-    # send them back to the animal. If True, this will exit the route completely and none
-    # of the rest of the route will be run.
-    if current_user != editAnimal.animalauthor:
-        flash("You can't edit a animal you don't own.")
-        return redirect(url_for('animal',animalID=animalID))
     # get the form object
     form = AnimalForm()
     # If the user has submitted the form then update the animal.
     if form.validate_on_submit():
-        # update() is mongoengine method for updating an existing document with new data.
-        editAnimal.update(
-            animalsubject = form.animalsubject.data,
-            animalcontent = form.animalcontent.data,
-            animaltag = form.animaltag.data,
-            animalmodify_date = dt.datetime.utcnow
+        # modify() is a mongoengine method that finds a document and updates it in one
+        # trip to the database. The query only matches if this user is the author AND
+        # nobody has changed the animal since the form was filled in (the version is the
+        # same). new=True gives back the animal after the update, or None if nothing matched.
+        editAnimal = Animal.objects(id=animalID, animalauthor=current_user.id, **matchVersion(form.version.data)).modify(
+            new = True,
+            set__animalsubject = form.animalsubject.data,
+            set__animalcontent = form.animalcontent.data,
+            set__animaltag = form.animaltag.data,
+            # a changed animal has to be approved again
+            set__animalapproval = PENDING,
+            set__animalmodify_date = dt.datetime.utcnow(),
+            inc__version = 1
         )
-        # After updating the document, send the user to the updated animal using a redirect.
+        if editAnimal:
+            rememberWrite()
+            # After updating the document, send the user to the updated animal using a redirect.
+            return redirect(url_for('animal',animalID=animalID))
+        # Nothing was updated so find out why.
+        latest = Animal.objects(id=animalID, animalauthor=current_user.id).first()
+        if latest is None:
+            flash("You can't edit a animal you don't own.")
+            return redirect(url_for('animal',animalID=animalID))
+        # Someone changed the animal after this form was filled in. Keep what the user typed,
+        # show them the newest version and let them decide whether to save over it.
+        flash("This animal was changed while you were editing it. The newest version is shown above the form. Click the button again to replace it with yours.")
+        form.version.data = latest.version
+        return render_template('animalform.html',form=form,latest=latest)
+
+    editAnimal = Animal.objects(id=animalID, animalauthor=current_user.id).first()
+    # if the user that requested to edit this animal is not the author then deny them and
+    # send them back to the animal. If True, this will exit the route completely and none
+    # of the rest of the route will be run.
+    if editAnimal is None:
+        flash("You can't edit a animal you don't own.")
         return redirect(url_for('animal',animalID=animalID))
 
     # if the form has NOT been submitted then take the data from the editAnimal object
@@ -150,6 +201,8 @@ def animalEdit(animalID):
     form.animalsubject.data = editAnimal.animalsubject
     form.animalcontent.data = editAnimal.animalcontent
     form.animaltag.data = editAnimal.animaltag
+    # the version is sent back with the form so we can tell if someone else saves first
+    form.version.data = editAnimal.version
 
 
     # Send the user to the animal form that is now filled out with the current information
@@ -176,26 +229,46 @@ def animalcommentNew(animalID):
             content = form.animalcontent.data
         )
         newComment.save()
+        rememberWrite()
         return redirect(url_for('animal',animalID=animalID))
     return render_template('animalform.html',form=form,animal=animal)
 
 @app.route('/animalcomment/edit/<commentID>', methods=['GET', 'POST'])
 @login_required
 def animalcommentEdit(commentID):
+    form = AnimalForm()
+    # This works the same way as animalEdit above.
+    if form.validate_on_submit():
+        editComment = Comment.objects(id=commentID, author=current_user.id, **matchVersion(form.version.data)).modify(
+            new = True,
+            set__content = form.animalcontent.data,
+            set__modify_date = dt.datetime.utcnow(),
+            inc__version = 1
+        )
+        if editComment:
+            rememberWrite()
+            # to_mongo() has the animal's id as it is stored. Using editComment.animal.id
+            # would load the whole animal from the database just to get its id.
+            return redirect(url_for('animal',animalID=editComment.to_mongo()['animal']))
+        latest = Comment.objects(id=commentID).first()
+        if latest is None:
+            flash("That comment was deleted.")
+            return redirect(url_for('animalList'))
+        if current_user != latest.author:
+            flash("You can't edit a comment you didn't write.")
+            return redirect(url_for('animal',animalID=latest.animal.id))
+        flash("This comment was changed while you were editing it. The newest version is shown above the form. Click the button again to replace it with yours.")
+        form.version.data = latest.version
+        return render_template('animalform.html',form=form,animal=latest.animal,latestcomment=latest)
+
     editComment = Comment.objects.get(id=commentID)
     if current_user != editComment.author:
         flash("You can't edit a comment you didn't write.")
         return redirect(url_for('animal',animalID=editComment.animal.id))
     animal = Animal.objects.get(id=editComment.animal.id)
-    form = AnimalForm()
-    if form.validate_on_submit():
-        editComment.update(
-            content = form.animalcontent.data,
-            modify_date = dt.datetime.utcnow
-        )
-        return redirect(url_for('animal',animalID=editComment.animal.id))
 
     form.animalcontent.data = editComment.content
+    form.version.data = editComment.version
 
     return render_template('animalform.html',form=form,animal=animal)   
 
@@ -204,5 +277,6 @@ def animalcommentEdit(commentID):
 def animalcommentDelete(commentID): 
     deleteComment = Comment.objects.get(id=commentID)
     deleteComment.delete()
+    rememberWrite()
     flash('The comments was deleted.')
     return redirect(url_for('animal',animalID=deleteComment.animal.id)) 
\ No newline at end of file
@@ -0,0 +1,267 @@
+# These routes are a JSON API so programs (like the climatesim2 game) can get the
+# blogs, animals, comments and users without reading the html pages. The version is in
+# the url (/api/v1/...) so the API can change later without breaking the game.
+#
+# Every resource uses the same url and the same query string options:
+#     /api/v1/blogs                            newest 20 blogs
+#     /api/v1/blogs?limit=50                   newest 50 blogs (at most 100)
+#     /api/v1/blogs?after=<id>                 the next page. Use the 'next' value from the last page
+#     /api/v1/blogs?ids=<id>,<id>,<id>         just these blogs, in one request
+#     /api/v1/blogs?fields=subject,tag         only send these fields
+#     /api/v1/blogs?expand=author              put the author's public fields in each blog
+#     /api/v1/comments?blog=<id>               the comments on one blog (or animal=<id>)
+#
+# Paging uses the id of the last item instead of a page number ("keyset" paging). MongoDB
+# can jump straight to that id with the _id index so page 100 is as fast as page 1.
+#
+# Who can use it: someone logged in to the site (the browser sends the session cookie)
+# or the game, which sends one of the keys listed in secrets.py as API_KEYS:
+#     Authorization: Bearer <key>
+# The game runs on another site (API_CORS_ORIGIN in secrets.py, ipppppi.github.io by
+# default) so the CORS headers below tell browsers it is allowed to call this API.
+# A key that is shipped inside a browser game can be read by anyone who plays it, so it
+# only identifies the game; it is not a password. Anything a key can read is public, so
+# with only a key you get approved blogs and animals (and their authors' public fields)
+# and nothing else. Comments, users and posts that aren't approved need a login.
+# Everything here is read only.
+#
+# These routes read straight from pymongo instead of making mongoengine objects because
+# that is a lot faster when all we want to do is turn the data into JSON. The author is
+# joined with $lookup so a page with authors is still one query.
+
+import hmac
+import json
+import datetime as dt
+from functools import wraps
+from bson.objectid import ObjectId
+from flask import request, Response
+from flask_login import current_user
+from app import app, secrets
+from app.classes.data import User, Blog, Animal, Comment, APPROVED
+from app.utils.readrouting import staleReadsOK, readCollection, causalSession
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+API_KEYS = secrets.get('API_KEYS', [])
+CORS_ORIGIN = secrets.get('API_CORS_ORIGIN', 'https://ipppppi.github.io')
+
+# These are the only User fields anyone can see through the API. Email, Google id and
+# the profile image are left out.
+PUBLIC_USER_FIELDS = ['username', 'fname', 'lname', 'gprofile_pic', 'role']
+
+# 'fields' is what can be asked for, 'author' is the field that points at a User,
+# 'filters' are query string options that match a reference field and 'approval' is the
+# approval field for resources that callers with only an API key can read.
+RESOURCES = {
+    'blogs': {
+        'document': Blog,
+        'fields': ['author', 'subject', 'content', 'tag', 'approval', 'create_date', 'modify_date'],
+        'author': 'author',
+        'filters': [],
+        'approval': 'approval',
+    },
+    'animals': {
+        'document': Animal,
+        'fields': ['animalauthor', 'animalsubject', 'animalcontent', 'animaltag', 'animalapproval', 'animalcreate_date', 'animalmodify_date'],
+        'author': 'animalauthor',
+        'filters': [],
+        'approval': 'animalapproval',
+    },
+    'comments': {
+        'document': Comment,
+        'fields': ['author', 'blog', 'animal', 'content', 'create_date', 'modify_date'],
+        'author': 'author',
+        'filters': ['blog', 'animal'],
+        'approval': None,
+    },
+    'users': {
+        'document': User,
+        'fields': PUBLIC_USER_FIELDS,
+        'author': None,
+        'filters': [],
+        'approval': None,
+    },
+}
+
+
+class APIError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def jsonDefault(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, dt.datetime):
+        # all dates are stored in UTC
+        return value.isoformat() + 'Z'
+    raise TypeError(repr(value))
+
+
+def jsonResponse(body, status=200):
+    text = json.dumps(body, default=jsonDefault, separators=(',', ':'))
+    return Response(text, status=status, mimetype='application/json')
+
+
+def parseID(value):
+    if not ObjectId.is_valid(value):
+        raise APIError("'{}' is not a valid id.".format(value))
+    return ObjectId(value)
+
+
+def parseList(name):
+    value = request.args.get(name, '')
+    return [item for item in value.split(',') if item]
+
+
+def parseLimit():
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError("'limit' must be a number.")
+    return max(1, min(limit, MAX_LIMIT))
+
+
+# This builds the aggregation pipeline for one request. Everything the request asks for
+# is done by MongoDB in this one pipeline.
+def buildPipeline(resource, approvedOnly):
+    allowed = resource['fields']
+    authorField = resource['author']
+
+    fields = parseList('fields')
+    for field in fields:
+        if field not in allowed:
+            raise APIError("'{}' is not a field you can ask for.".format(field))
+    if not fields:
+        fields = allowed
+
+    expand = parseList('expand')
+    for name in expand:
+        if name != 'author' or authorField is None:
+            raise APIError("'{}' can't be expanded here.".format(name))
+
+    match = {}
+    limit = parseLimit()
+    ids = parseList('ids')
+    if ids:
+        if len(ids) > MAX_LIMIT:
+            raise APIError("You can ask for at most {} ids at once.".format(MAX_LIMIT))
+        match['_id'] = {'$in': [parseID(id) for id in ids]}
+        # there is no next page when asking for ids so send all of them
+        limit = len(ids)
+    after = request.args.get('after')
+    if after:
+        match.setdefault('_id', {})['$lt'] = parseID(after)
+    for name in resource['filters']:
+        value = request.args.get(name)
+        if value:
+            match[name] = parseID(value)
+    if approvedOnly:
+        match[resource['approval']] = APPROVED
+
+    pipeline = [
+        {'$match': match},
+        # newest first. ObjectIds start with the time they were made.
+        {'$sort': {'_id': -1}},
+        {'$limit': limit},
+    ]
+
+    projection = {field: 1 for field in fields}
+    # only join the author when it is one of the fields being sent
+    if expand and authorField in fields:
+        pipeline.append({'$lookup': {
+            'from': User._get_collection_name(),
+            'localField': authorField,
+            'foreignField': '_id',
+            'as': authorField,
+        }})
+        pipeline.append({'$unwind': {'path': '$' + authorField, 'preserveNullAndEmptyArrays': True}})
+        projection.pop(authorField, None)
+        projection[authorField + '._id'] = 1
+        for field in PUBLIC_USER_FIELDS:
+            projection[authorField + '.' + field] = 1
+    pipeline.append({'$project': projection})
+    return pipeline
+
+
+def renameID(document):
+    document['id'] = document.pop('_id')
+    for value in document.values():
+        if isinstance(value, dict) and '_id' in value:
+            value['id'] = value.pop('_id')
+    return document
+
+
+def validAPIKey():
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return False
+    key = header[len('Bearer '):].strip()
+    # compare_digest takes the same time whether the key is close or not
+    return any(hmac.compare_digest(key, apiKey) for apiKey in API_KEYS)
+
+
+# Like @login_required but it also accepts an API key, and it answers with a JSON 401
+# instead of sending the user to the home page.
+def apiLoginRequired(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not (validAPIKey() or current_user.is_authenticated):
+            response = jsonResponse({'error': 'Log in or send an API key in the Authorization header.'}, 401)
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        return view(*args, **kwargs)
+    return wrapper
+
+
+# This adds the CORS headers to every /api/ response, including the OPTIONS "preflight"
+# request the browser sends before a cross-site request with an Authorization header.
+@app.after_request
+def apiCORS(response):
+    if request.path.startswith('/api/') and request.headers.get('Origin') == CORS_ORIGIN:
+        response.headers['Access-Control-Allow-Origin'] = CORS_ORIGIN
+        response.headers['Access-Control-Allow-Headers'] = 'Authorization, If-None-Match'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Expose-Headers'] = 'ETag'
+        response.headers['Access-Control-Max-Age'] = '3600'
+    if request.path.startswith('/api/'):
+        response.vary.add('Origin')
+    return response
+
+
+@app.route('/api/v1/<resourceName>')
+@staleReadsOK
+@apiLoginRequired
+def apiList(resourceName):
+    resource = RESOURCES.get(resourceName)
+    if resource is None:
+        return jsonResponse({'error': "There is no '{}' in the API.".format(resourceName)}, 404)
+
+    # the game (an API key but nobody logged in) only gets what is public
+    keyOnly = not current_user.is_authenticated
+    if keyOnly and resource['approval'] is None:
+        return jsonResponse({'error': "Log in to read '{}'.".format(resourceName)}, 403)
+
+    try:
+        pipeline = buildPipeline(resource, keyOnly)
+    except APIError as error:
+        return jsonResponse({'error': error.message}, error.status)
+
+    collection = readCollection(resource['document'])
+    documents = [renameID(document) for document in collection.aggregate(pipeline, session=causalSession())]
+
+    # If we got a full page there might be more so tell the client where to start next time.
+    # When the client asked for ids there are no more pages.
+    nextID = None
+    if documents and len(documents) == parseLimit() and not request.args.get('ids'):
+        nextID = documents[-1]['id']
+
+    response = jsonResponse({'data': documents, 'next': nextID})
+    # The ETag is a fingerprint of the response. If the client sends it back in
+    # If-None-Match and nothing has changed it gets an empty 304 instead of the data.
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
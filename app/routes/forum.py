@@ -3,27 +3,41 @@
 # Created, Read, Updated or Deleted (CRUD)
 
 from app import app
+from bson.objectid import ObjectId
 import mongoengine.errors
-from flask import render_template, flash, redirect, url_for
+from flask import render_template, flash, redirect, url_for, Response, stream_with_context, request
 from flask_login import current_user
-from app.classes.data import Blog, Comment
+from app.classes.data import Blog, Comment, APPROVED, PENDING, matchVersion
 from app.classes.forms import BlogForm, CommentForm
+from app.utils.commentstream import commentEvents
+from app.utils.readrouting import staleReadsOK, findDocument, findDocuments, rememberWrite
 from flask_login import login_required
 import datetime as dt
 
 # This is the route to list all blogs
 @app.route('/blog/list')
 @app.route('/blogs')
+# This page can show blogs that are a moment old so it can read from a secondary.
+# See app/utils/readrouting.py
+@staleReadsOK
 # This means the user must be logged in to see this page
 @login_required
 def blogList():
     # This retrieves all of the 'blogs' that are stored in MongoDB and places them in a
     # mongoengine object as a list of dictionaries name 'blogs'.
-    blogs = Blog.objects()
+    # findDocuments reads from a secondary that has caught up with this user's own
+    # writes and brings each author along in the same query. See app/utils/readrouting.py
+    # /blogs?approved=1 only shows the blogs a teacher has approved. This query uses the
+    # same (approval, create_date) index as the moderation page.
+    approvedOnly = request.args.get('approved') == '1'
+    if approvedOnly:
+        blogs = findDocuments(Blog, {'approval': APPROVED}, [('create_date', -1)], authorField='author')
+    else:
+        blogs = findDocuments(Blog, authorField='author')
     # This renders (shows to the user) the blogs.html template. it also sends the blogs object 
     # to the template as a variable named blogs.  The template uses a for loop to display
     # each blog.
-    return render_template('blogs.html',blogs=blogs)
+    return render_template('blogs.html',blogs=blogs,approvedOnly=approvedOnly)
 
 # This route will get one specific blog and any comments associated with that blog.  
 # The blogID is a variable that must be passsed as a parameter to the function and 
@@ -31,20 +45,33 @@ def blogList():
 # is called when the user clicks a link on bloglist.html template.
 # The angle brackets (<>) indicate a variable. 
 @app.route('/blog/<blogID>')
+@staleReadsOK
 # This route will only run if the user is logged in.
 @login_required
 def blog(blogID):
     # retrieve the blog using the blogID
-    thisBlog = Blog.objects.get(id=blogID)
+    thisBlog = findDocument(Blog, {'_id': ObjectId(blogID)}, authorField='author')
     # If there are no comments the 'comments' object will have the value 'None'. Comments are 
     # related to blogs meaning that every comment contains a reference to a blog. In this case
     # there is a field on the comment collection called 'blog' that is a reference the Blog
     # document it is related to.  You can use the blogID to get the blog and then you can use
     # the blog object (thisBlog in this case) to get all the comments.
-    theseComments = Comment.objects(blog=thisBlog)
+    theseComments = findDocuments(Comment, {'blog': ObjectId(blogID)}, authorField='author')
     # Send the blog object and the comments object to the 'blog.html' template.
     return render_template('blog.html',blog=thisBlog,comments=theseComments)
 
+# This route never finishes. The blog page opens it with an EventSource and it sends
+# the html for new or edited comments (and the id of deleted comments) as they happen
+# so nobody has to refresh the page. See app/utils/commentstream.py for how it works.
+@app.route('/blog/<blogID>/stream')
+@login_required
+def blogStream(blogID):
+    def renderComment(comment):
+        return render_template('includes/_comment.html',comment=comment,commentroute='comment')
+    # stream_with_context keeps current_user available while the stream is open
+    events = stream_with_context(commentEvents('blog',blogID,renderComment))
+    return Response(events, mimetype='text/event-stream', headers={'Cache-Control':'no-cache','X-Accel-Buffering':'no'})
+
 # This route will delete a specific blog.  You can only delete the blog if you are the author.
 # <blogID> is a variable sent to this route by the user who clicked on the trash can in the 
 # template 'blog.html'. 
@@ -60,6 +87,8 @@ def blogDelete(blogID):
     if current_user == deleteBlog.author:
         # delete the blog using the delete() method from Mongoengine
         deleteBlog.delete()
+        # this user just changed something so make sure their next reads see it
+        rememberWrite()
         # send a message to the user that the blog was deleted.
         flash('The Blog was deleted.')
     else:
@@ -98,13 +127,17 @@ def blogNew():
             subject = form.subject.data,
             content = form.content.data,
             tag = form.tag.data,
-            approval = form.approval.data,
+            # every new blog waits in the moderation queue until a teacher approves it
+            approval = PENDING,
             author = current_user.id,
             # This sets the modifydate to the current datetime.
-            modify_date = dt.datetime.utcnow
+            modify_date = dt.datetime.utcnow()
         )
         # This is a method that saves the data to the mongoDB database.
         newBlog.save()
+        # Make sure this user's next reads see the new blog even if they go to a
+        # secondary that hasn't copied it yet.
+        rememberWrite()
 
         # Once the new blog is saved, this sends the user to that blog using redirect.
         # and url_for. Redirect is used to redirect a user to different route so that 
@@ -128,25 +161,45 @@ def blogNew():
 @app.route('/blog/edit/<blogID>', methods=['GET', 'POST'])
 @login_required
 def blogEdit(blogID):
-    editBlog = Blog.objects.get(id=blogID)
-    # if the user that requested to edit this blog is not the author then deny them and
-    # send them back to the blog. If True, this will exit the route completely and none
-    # of the rest of the route will be run.
-    if current_user != editBlog.author:
-        flash("You can't edit a blog you don't own.")
-        return redirect(url_for('blog',blogID=blogID))
     # get the form object
     form = BlogForm()
     # If the user has submitted the form then update the blog.
     if form.validate_on_submit():
-        # update() is mongoengine method for updating an existing document with new data.
-        editBlog.update(
-            subject = form.subject.data,
-            content = form.content.data,
-            tag = form.tag.data,
-            modify_date = dt.datetime.utcnow
+        # modify() is a mongoengine method that finds a document and updates it in one
+        # trip to the database. The query only matches if this user is the author AND
+        # nobody has changed the blog since the form was filled in (the version is the
+        # same). new=True gives back the blog after the update, or None if nothing matched.
+        editBlog = Blog.objects(id=blogID, author=current_user.id, **matchVersion(form.version.data)).modify(
+            new = True,
+            set__subject = form.subject.data,
+            set__content = form.content.data,
+            set__tag = form.tag.data,
+            # a changed blog has to be approved again
+            set__approval = PENDING,
+            set__modify_date = dt.datetime.utcnow(),
+            inc__version = 1
         )
-        # After updating the document, send the user to the updated blog using a redirect.
+        if editBlog:
+            rememberWrite()
+            # After updating the document, send the user to the updated blog using a redirect.
+            return redirect(url_for('blog',blogID=blogID))
+        # Nothing was updated so find out why.
+        latest = Blog.objects(id=blogID, author=current_user.id).first()
+        if latest is None:
+            flash("You can't edit a blog you don't own.")
+            return redirect(url_for('blog',blogID=blogID))
+        # Someone changed the blog after this form was filled in. Keep what the user typed,
+        # show them the newest version and let them decide whether to save over it.
+        flash("This blog was changed while you were editing it. The newest version is shown above the form. Click the button again to replace it with yours.")
+        form.version.data = latest.version
+        return render_template('blogform.html',form=form,latest=latest)
+
+    editBlog = Blog.objects(id=blogID, author=current_user.id).first()
+    # if the user that requested to edit this blog is not the author then deny them and
+    # send them back to the blog. If True, this will exit the route completely and none
+    # of the rest of the route will be run.
+    if editBlog is None:
+        flash("You can't edit a blog you don't own.")
         return redirect(url_for('blog',blogID=blogID))
 
     # if the form has NOT been submitted then take the data from the editBlog object
@@ -154,6 +207,8 @@ def blogEdit(blogID):
     form.subject.data = editBlog.subject
     form.content.data = editBlog.content
     form.tag.data = editBlog.tag
+    # the version is sent back with the form so we can tell if someone else saves first
+    form.version.data = editBlog.version
 
 
     # Send the user to the blog form that is now filled out with the current information
@@ -180,26 +235,46 @@ def commentNew(blogID):
             content = form.content.data
         )
         newComment.save()
+        rememberWrite()
         return redirect(url_for('blog',blogID=blogID))
     return render_template('commentform.html',form=form,blog=blog)
 
 @app.route('/comment/edit/<commentID>', methods=['GET', 'POST'])
 @login_required
 def commentEdit(commentID):
+    form = CommentForm()
+    # This works the same way as blogEdit above.
+    if form.validate_on_submit():
+        editComment = Comment.objects(id=commentID, author=current_user.id, **matchVersion(form.version.data)).modify(
+            new = True,
+            set__content = form.content.data,
+            set__modify_date = dt.datetime.utcnow(),
+            inc__version = 1
+        )
+        if editComment:
+            rememberWrite()
+            # to_mongo() has the blog's id as it is stored. Using editComment.blog.id
+            # would load the whole blog from the database just to get its id.
+            return redirect(url_for('blog',blogID=editComment.to_mongo()['blog']))
+        latest = Comment.objects(id=commentID).first()
+        if latest is None:
+            flash("That comment was deleted.")
+            return redirect(url_for('blogList'))
+        if current_user != latest.author:
+            flash("You can't edit a comment you didn't write.")
+            return redirect(url_for('blog',blogID=latest.blog.id))
+        flash("This comment was changed while you were editing it. The newest version is shown above the form. Click the button again to replace it with yours.")
+        form.version.data = latest.version
+        return render_template('commentform.html',form=form,blog=latest.blog,latest=latest)
+
     editComment = Comment.objects.get(id=commentID)
     if current_user != editComment.author:
         flash("You can't edit a comment you didn't write.")
         return redirect(url_for('blog',blogID=editComment.blog.id))
     blog = Blog.objects.get(id=editComment.blog.id)
-    form = CommentForm()
-    if form.validate_on_submit():
-        editComment.update(
-            content = form.content.data,
-            modify_date = dt.datetime.utcnow
-        )
-        return redirect(url_for('blog',blogID=editComment.blog.id))
 
     form.content.data = editComment.content
+    form.version.data = editComment.version
 
     return render_template('commentform.html',form=form,blog=blog)   
 
@@ -208,5 +283,6 @@ def commentEdit(commentID):
 def commentDelete(commentID): 
     deleteComment = Comment.objects.get(id=commentID)
     deleteComment.delete()
+    rememberWrite()
     flash('The comments was deleted.')
     return redirect(url_for('blog',blogID=deleteComment.blog.id)) 
@@ -11,8 +11,11 @@ from flask_login import (
 )
 from oauthlib.oauth2 import WebApplicationClient
 import requests
-from app.classes.data import User
+from app.classes.data import User, nameKey
 from app.utils.secrets import getSecrets
+from app.utils.readrouting import findDocument, rememberWrite
+from bson.objectid import ObjectId
+from app.utils.userdirectory import clearUserDirectory
 import mongoengine.errors
 
 #get all the credentials for google
@@ -32,11 +35,13 @@ def unauthorized():
 # https://flask-login.readthedocs.io/en/latest/#flask_login.LoginManager.user_loader
 @login_manager.user_loader
 def load_user(id):
-    try:
-        return User.objects.get(pk=id)
-    except mongoengine.errors.DoesNotExist:
+    # This runs on every request. findDocument() uses a secondary only on
+    # routes marked with @staleReadsOK, everywhere else it reads the primary.
+    user = findDocument(User, {'_id': ObjectId(id)}) if ObjectId.is_valid(id) else None
+    if user is None:
         flash("Something strange has happened. This user doesn't exist. Please click logout.")
         return redirect(url_for('index'))
+    return user
 
 def get_google_provider_cfg():
     return requests.get(secrets['GOOGLE_DISCOVERY_URL']).json()
@@ -136,8 +141,11 @@ def callback():
                 fname = gfname,
                 lname = glname
             )
+            # save() sets namekey (see User.clean in data.py)
             thisUser.save()
             thisUser.reload()
+            # A new person for the user directory
+            clearUserDirectory()
         else:
             flash("You must have an ousd.org email to login to this site.")
             return redirect(url_for('index'))
@@ -147,9 +155,15 @@ def callback():
             gname=gname, 
             gprofile_pic=gprofile_pic,
             fname = gfname,
-            lname = glname
+            lname = glname,
+            namekey = nameKey(gfname, glname)
         )
+        # Their name might have changed in Google so the user directory could be wrong
+        if (thisUser.fname, thisUser.lname) != (gfname, glname):
+            clearUserDirectory()
     thisUser.reload()
+    # The user's record was just written so make sure their next reads see it
+    rememberWrite()
 
     # Begin user session by logging the user in
     login_user(thisUser)
@@ -0,0 +1,52 @@
+# These routes are the moderation queue for teachers. Instead of opening every blog and
+# animal one at a time, a teacher sees everything that is waiting for approval on one page,
+# ticks the ones they want and approves or rejects them all with one click.
+#
+# The queries here use the (approval, create_date) indexes defined in data.py so MongoDB
+# can go straight to the waiting posts, already in date order, without looking at the rest.
+
+from app import app
+from bson.objectid import ObjectId
+from flask import render_template, flash, redirect, url_for, request
+from flask_login import current_user, login_required
+from app.classes.data import Blog, Animal, APPROVED, PENDING, REJECTED
+from app.classes.forms import ModerationForm
+from app.utils.readrouting import rememberWrite
+
+# Posts made before the moderation queue existed might not have an approval at all.
+# 'None' finds those and it can still use the index.
+WAITING = [PENDING, None]
+
+
+@app.route('/moderation', methods=['GET', 'POST'])
+@login_required
+def moderation():
+    if current_user.role != 'Teacher':
+        flash("Only teachers can moderate posts.")
+        return redirect(url_for('index'))
+
+    form = ModerationForm()
+    if form.validate_on_submit():
+        # which button was clicked
+        newApproval = APPROVED if form.approve.data else REJECTED
+        # the checkboxes on the page are named blogIDs and animalIDs. Anything that isn't a
+        # real id would make the query fail so it is left out.
+        blogIDs = [id for id in request.form.getlist('blogIDs') if ObjectId.is_valid(id)]
+        animalIDs = [id for id in request.form.getlist('animalIDs') if ObjectId.is_valid(id)]
+        # queryset.update() changes every matching document in a single update_many so
+        # approving 30 posts is one trip to the database for each collection, not 30.
+        # Only posts that are still waiting are changed in case another teacher got there first.
+        blogCount = 0
+        animalCount = 0
+        if blogIDs:
+            blogCount = Blog.objects(id__in=blogIDs, approval__in=WAITING).update(approval=newApproval)
+        if animalIDs:
+            animalCount = Animal.objects(id__in=animalIDs, animalapproval__in=WAITING).update(animalapproval=newApproval)
+        rememberWrite()
+        action = 'approved' if newApproval == APPROVED else 'rejected'
+        flash("{} blogs and {} animals were {}.".format(blogCount, animalCount, action))
+        return redirect(url_for('moderation'))
+
+    blogs = Blog.objects(approval__in=WAITING).order_by('-create_date')
+    animals = Animal.objects(animalapproval__in=WAITING).order_by('-animalcreate_date')
+    return render_template('moderation.html', form=form, blogs=blogs, animals=animals)
@@ -1,14 +1,21 @@
 from app import app
 from flask_login.utils import login_required
-from flask import render_template, redirect, flash, url_for
+from flask import render_template, redirect, flash, url_for, request, Response
 from app.classes.data import User
 from app.classes.forms import ProfileForm
 from flask_login import current_user
+from app.utils.readrouting import staleReadsOK, findDocument, rememberWrite
+from bson.objectid import ObjectId
+from app.utils.userdirectory import findUsers, clearUserDirectory
 
 # These routes and functions are for accessing and editing user profiles.
 
 # The first line is what listens for the user to type 'myprofile'
 @app.route('/myprofile')
+# This page only reads the logged in user (through current_user) and can show it a
+# moment old, so that read can go to a secondary. It has to come before @login_required
+# because @login_required is what loads current_user.
+@staleReadsOK
 # This line tells the user that they cannot access this without being loggedin
 @login_required
 # This is the function that is run when the route is triggered
@@ -29,19 +36,22 @@ def profileEdit():
     if form.validate_on_submit():
         # if the form was valid then this gets an object that represents the currUser's data
         currUser = User.objects.get(id=current_user.id)
-        # This updates the data on the user record that was collected from the form
-        currUser.update(
-            lname = form.lname.data,
-            fname = form.fname.data,
-            role = form.role.data
-        )
+        # This changes the data on the user record that was collected from the form
+        currUser.lname = form.lname.data
+        currUser.fname = form.fname.data
         # This updates the profile image
         if form.image.data:
             if currUser.image:
                 currUser.image.delete()
             currUser.image.put(form.image.data, content_type = 'image/jpeg')
-            # This saves all the updates
-            currUser.save()
+        # This saves all the updates at once. save() runs User.clean() which sets namekey
+        # from the new name.
+        currUser.save()
+        # The user directory might be showing the old name
+        clearUserDirectory()
+        # Their profile page reads from a secondary so make sure this user's next
+        # reads see the changes they just made.
+        rememberWrite()
         # Then sends the user to their profle page
         return redirect(url_for('myProfile'))
 
@@ -49,6 +59,48 @@ def profileEdit():
     # then sends the user to the page with the edit profile form
     form.fname.data = current_user.fname
     form.lname.data = current_user.lname
-    form.role.data = current_user.role
 
     return render_template('profileform.html', form=form)
+
+
+# This is the directory of everyone on the site. The search box finds people whose
+# name starts with what you type, last name first (try 'chen' or 'chen xi').
+# /users?search=chen&page=2
+@app.route('/users')
+@staleReadsOK
+@login_required
+def userList():
+    search = request.args.get('search', '')
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    # findUsers is in app/utils/userdirectory.py. It remembers recent pages so most
+    # visits don't need to ask the database at all.
+    users, morePages = findUsers(search, page)
+    return render_template('users.html', users=users, search=search, page=page, morePages=morePages)
+
+# This sends a user's profile image by itself so the directory can show lots of
+# thumbnails with normal <img> tags. The pages link to /user/<id>/image?v=<image id>.
+# A new upload gets a new image id and so a new url, which means the browser can keep
+# the image for a year. Without the right v it has to check back every time (the ETag
+# makes that check an empty 304 when the image hasn't changed).
+@app.route('/user/<userID>/image')
+@staleReadsOK
+@login_required
+def userImage(userID):
+    user = findDocument(User, {'_id': ObjectId(userID)}) if ObjectId.is_valid(userID) else None
+    if user is None or not user.image:
+        return redirect(url_for('static', filename='bdog.png'))
+    imageID = str(user.image.grid_id)
+    # the browser already has this image so don't read it out of GridFS again
+    if imageID in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(user.image.read(), mimetype=user.image.content_type or 'image/jpeg')
+    response.set_etag(imageID)
+    if request.args.get('v') == imageID:
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,39 @@
+# This is the asyncio version of the database connection in app/__init__.py. It uses
+# Motor, which talks to MongoDB without blocking, so the async routes in
+# app/asyncroutes.py can wait on many queries at once.
+#
+# The client is made the first time it is used so it belongs to the event loop that
+# is running the site (Motor clients can't move between event loops).
+
+import certifi
+from motor.motor_asyncio import AsyncIOMotorClient
+from app import secrets
+from app.utils.readrouting import currentReadPreference, advanceToLastWrite
+
+motorClient = None
+
+
+def asyncDB():
+    global motorClient
+    if motorClient is None:
+        if secrets.get('MONGO_TLS', True):
+            motorClient = AsyncIOMotorClient(secrets['MONGO_HOST'], tlsCAFile=certifi.where())
+        else:
+            motorClient = AsyncIOMotorClient(secrets['MONGO_HOST'])
+    return motorClient[secrets['MONGO_DB_NAME']]
+
+
+# This gets the Motor collection for a mongoengine Document class, reading from a
+# secondary or the primary the same way readCollection() does for the sync routes.
+def asyncCollection(document):
+    return asyncDB().get_collection(document._get_collection_name(), read_preference=currentReadPreference())
+
+
+# A causally consistent Motor session that has seen this user's last write, like
+# causalSession() in readrouting.py. A session can only run one query at a time so
+# queries that run together with asyncio.gather each need their own. Use it like:
+#     async with await asyncCausalSession() as clientSession:
+async def asyncCausalSession():
+    asyncDB()
+    clientSession = await motorClient.start_session(causal_consistency=True)
+    return advanceToLastWrite(clientSession)
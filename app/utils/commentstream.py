@@ -0,0 +1,214 @@
+# This file lets browsers see new comments without refreshing the page. Instead of every
+# browser asking MongoDB for the comments over and over, ONE background thread opens a
+# MongoDB "change stream" on the comment collection. MongoDB tells that thread every time
+# a comment is created, edited or deleted and the thread hands the change to every browser
+# (subscriber) that is looking at that blog or animal.
+#
+# Change streams only work when MongoDB is running as a replica set. Atlas always is. To
+# run one on your own computer see the "Local replica set" section in setup.txt.
+#
+# Each browser connection waits on its own queue. When the site runs with the gevent worker
+# from gunicorn.conf.py the thread and the queues are greenlets, so a browser that keeps a
+# stream open does not tie up a whole worker. When it runs as an ASGI app (asgi.py) the
+# stream routes in app/asyncroutes.py wait on an AsyncSubscriber instead, so an open
+# stream is just a waiting coroutine and not a thread.
+
+import asyncio
+import collections
+import queue
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+from app import app
+from app.classes.data import Comment, User
+
+# How long a subscriber waits for a change before sending a keepalive. The keepalive is
+# how we find out that a browser has gone away so we can stop sending to it.
+HEARTBEAT_SECONDS = 15
+
+# How many changes can wait for a slow browser before we start dropping them.
+QUEUE_SIZE = 100
+
+# How many comment ids we remember so a delete can be sent to the right post.
+OWNER_CACHE_SIZE = 10000
+
+# MongoDB error code for "The $changeStream stage is only supported on replica sets"
+NOT_A_REPLICA_SET = 40573
+
+
+class CommentStream:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (kind, postID) --> set of queues, one queue for each open browser connection.
+        # kind is 'blog' or 'animal' because comments can belong to either.
+        self.subscribers = {}
+        # commentID --> (kind, postID). A delete only tells us the id of the comment that
+        # was deleted, so we remember where the comments we have seen belong.
+        self.owners = collections.OrderedDict()
+        self.thread = None
+        self.resumeToken = None
+
+    # A subscriber is anything with put_nowait() that raises queue.Full when it is full.
+    def subscribe(self, kind, postID, subscriber=None):
+        self.start()
+        if subscriber is None:
+            subscriber = queue.Queue(maxsize=QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.setdefault((kind, str(postID)), set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, kind, postID, subscriber):
+        key = (kind, str(postID))
+        with self.lock:
+            subscribers = self.subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[key]
+
+    # The watcher is started the first time someone subscribes. That way each gunicorn
+    # worker gets its own watcher after it has been forked.
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.watch, name='comment-stream', daemon=True)
+                self.thread.start()
+
+    def watch(self):
+        collection = Comment._get_collection()
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+        while True:
+            try:
+                # 'updateLookup' asks MongoDB to send the whole comment on an edit, not just
+                # the fields that changed. resume_after picks up where we left off if the
+                # connection to MongoDB was lost.
+                with collection.watch(pipeline, full_document='updateLookup', resume_after=self.resumeToken) as stream:
+                    for change in stream:
+                        self.resumeToken = stream.resume_token
+                        self.publish(change)
+            except OperationFailure as error:
+                if error.code == NOT_A_REPLICA_SET:
+                    # Nothing will ever come from this database so stop trying. The stream
+                    # routes will still work, they will just only send keepalives.
+                    app.logger.warning("Live comments are off: MongoDB is not running as a replica set.")
+                    return
+                self.resumeToken = None
+                time.sleep(1)
+            except PyMongoError:
+                time.sleep(1)
+
+    def publish(self, change):
+        commentID = str(change['documentKey']['_id'])
+        comment = change.get('fullDocument')
+        # an edit can be looked up after the comment was already deleted
+        op = 'delete' if comment is None else change['operationType']
+
+        with self.lock:
+            if comment is not None:
+                key = postKey(comment)
+                if key in self.subscribers:
+                    self.owners[commentID] = key
+                    self.owners.move_to_end(commentID)
+                    if len(self.owners) > OWNER_CACHE_SIZE:
+                        self.owners.popitem(last=False)
+            else:
+                key = self.owners.pop(commentID, None)
+
+            if key is not None:
+                subscribers = list(self.subscribers.get(key, ()))
+            elif op == 'delete':
+                # We don't know which post this comment was on. A delete is only the id
+                # so it is cheap to tell everyone and let the page ignore ids it doesn't have.
+                subscribers = [s for group in self.subscribers.values() for s in group]
+            else:
+                subscribers = []
+
+        if not subscribers:
+            return
+        # Build the comment and load its author ONCE here, not in every subscriber, so a
+        # change costs one User query no matter how many browsers are watching. Each
+        # subscriber only draws it (the edit/delete links depend on who is looking).
+        if comment is not None:
+            comment = self.loadComment(comment)
+        event = {'op': op, 'id': commentID, 'comment': comment}
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                # This browser is not keeping up. Skip it rather than slow everyone down.
+                pass
+
+    def loadComment(self, son):
+        comment = Comment._from_son(son)
+        if son.get('author') is not None:
+            authorSon = User._get_collection().find_one({'_id': son['author']})
+            if authorSon is not None:
+                # an author that is already an object doesn't get loaded again by the template
+                comment.author = User._from_son(authorSon)
+        return comment
+
+
+# A subscriber for the async stream routes. The watcher thread can't touch an asyncio.Queue
+# directly because it belongs to the event loop, so put_nowait() asks the loop to do it.
+class AsyncSubscriber:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    # this is called by the watcher thread
+    def put_nowait(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self.put, event)
+        except RuntimeError:
+            # the event loop has shut down. The stream is gone too.
+            pass
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the same as queue.Full in publish(): skip a browser that is not keeping up
+            pass
+
+
+def postKey(comment):
+    if comment.get('blog') is not None:
+        return ('blog', str(comment['blog']))
+    if comment.get('animal') is not None:
+        return ('animal', str(comment['animal']))
+    return None
+
+
+# There is only one CommentStream for each running copy of the site.
+commentStream = CommentStream()
+
+
+# This turns one change into the text format that Server-Sent Events use. Every line of
+# the data has to start with 'data: ' and the message ends with a blank line.
+def sseMessage(event, data):
+    lines = ''.join('data: {}\n'.format(line) for line in data.splitlines() or [''])
+    return 'event: {}\n{}\n'.format(event, lines)
+
+
+# This is the generator that a stream route sends to the browser. 'renderComment' is a
+# function that turns a comment into the html fragment for that page.
+def commentEvents(kind, postID, renderComment):
+    subscriber = commentStream.subscribe(kind, postID)
+    try:
+        # tell the browser to wait 5 seconds before reconnecting if the connection drops
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                event = subscriber.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                # lines starting with ':' are comments in SSE and are ignored by the browser
+                yield ': keepalive\n\n'
+                continue
+            if event['op'] == 'delete':
+                yield sseMessage('delete', event['id'])
+            else:
+                name = 'new' if event['op'] == 'insert' else 'edit'
+                yield sseMessage(name, renderComment(event['comment']))
+    finally:
+        # this runs when the browser goes away and the server stops the generator
+        commentStream.unsubscribe(kind, postID, subscriber)
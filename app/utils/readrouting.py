@@ -0,0 +1,131 @@
+# This file decides which MongoDB server a query reads from. A replica set has one
+# primary, which takes all the writes, and secondaries, which copy the primary a tiny
+# bit later. Reading from a secondary takes load off the primary, but the data might be
+# a moment old.
+#
+# Pages that only show lists or single posts don't mind being a moment old, so their
+# routes are marked with @staleReadsOK and their queries go to 'secondaryPreferred'.
+# Every other route reads from the primary like before.
+#
+# The one time stale data is a problem is right after you change something. If you
+# write a blog and get sent to it, a secondary might not have it yet. So every route
+# that writes calls rememberWrite(). That asks the primary for its newest "operation
+# time" (which is at or after the write) and keeps it in the Flask session cookie. Later
+# reads by that user use a causally consistent ClientSession that has been moved up to
+# that time, and MongoDB makes a secondary wait until it has caught up to it before
+# answering. That way a user always sees their own writes, however far behind the
+# secondaries are. (The writes use the default write concern, so this holds in normal
+# running but not if the primary fails before the write reaches a secondary.)
+#
+# mongoengine 0.20 querysets can't be given a ClientSession, so the stale-ok routes read
+# with findDocument()/findDocuments() below, which use pymongo on the collection
+# directly and turn the results back into mongoengine objects:
+#     blogs = findDocuments(Blog, authorField='author')
+#     thisBlog = findDocument(Blog, {'_id': ObjectId(blogID)}, authorField='author')
+# mongoengine would load each author on its own, from the primary and outside the
+# session, the first time a template used it. authorField joins the authors into the
+# same query instead (like the API and the async routes do).
+
+from functools import wraps
+from bson import json_util
+from bson.son import SON
+from flask import g, session
+from mongoengine.connection import get_connection, get_db
+from pymongo import ReadPreference
+from app import app
+from app.classes.data import User
+
+
+def staleReadsOK(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.staleReadsOK = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def currentReadPreference():
+    if g.get('staleReadsOK'):
+        return ReadPreference.SECONDARY_PREFERRED
+    return ReadPreference.PRIMARY
+
+
+# Keeps the times from a session that has seen a write in the Flask session. The async
+# routes call this directly with the times from their Motor session.
+def storeLastWrite(operationTime, clusterTime):
+    # a database that isn't a replica set has no operation times and doesn't need them
+    if operationTime is None or clusterTime is None:
+        return
+    session['lastWrite'] = json_util.dumps({'operationTime': operationTime, 'clusterTime': clusterTime})
+
+
+def rememberWrite():
+    # The write was already acknowledged by the primary, so the operation time the primary
+    # reports for this ping is at or after the write.
+    with get_connection().start_session(causal_consistency=True) as clientSession:
+        get_db().command('ping', session=clientSession)
+        storeLastWrite(clientSession.operation_time, clientSession.cluster_time)
+
+
+# Moves a pymongo or Motor ClientSession up to this user's last write.
+def advanceToLastWrite(clientSession):
+    lastWrite = session.get('lastWrite')
+    if lastWrite:
+        times = json_util.loads(lastWrite)
+        clientSession.advance_cluster_time(times['clusterTime'])
+        clientSession.advance_operation_time(times['operationTime'])
+    return clientSession
+
+
+# One causally consistent session per request. It is ended in endCausalSession below.
+def causalSession():
+    if 'causalSession' not in g:
+        g.causalSession = advanceToLastWrite(get_connection().start_session(causal_consistency=True))
+    return g.causalSession
+
+
+@app.teardown_request
+def endCausalSession(error=None):
+    clientSession = g.pop('causalSession', None)
+    if clientSession is not None:
+        clientSession.end_session()
+
+
+def readCollection(document):
+    return document._get_collection().with_options(read_preference=currentReadPreference())
+
+
+def findDocuments(document, query=None, sort=None, authorField=None, limit=None):
+    if authorField is None:
+        cursor = readCollection(document).find(query or {}, session=causalSession())
+        if sort:
+            cursor = cursor.sort(sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [document._from_son(son) for son in cursor]
+
+    pipeline = [{'$match': query or {}}]
+    if sort:
+        pipeline.append({'$sort': SON(sort)})
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline.append({'$lookup': {
+        'from': User._get_collection_name(),
+        'localField': authorField,
+        'foreignField': '_id',
+        'as': authorField,
+    }})
+    found = []
+    for son in readCollection(document).aggregate(pipeline, session=causalSession()):
+        authors = son.pop(authorField, None) or []
+        thisDocument = document._from_son(son)
+        if authors:
+            # an author that is already an object doesn't get loaded again by the template
+            setattr(thisDocument, authorField, User._from_son(authors[0]))
+        found.append(thisDocument)
+    return found
+
+
+def findDocument(document, query, authorField=None):
+    found = findDocuments(document, query, authorField=authorField, limit=1)
+    return found[0] if found else None
@@ -0,0 +1,65 @@
+# This is the data behind the /users directory page. Looking up a page of users is a
+# database query, and lots of students look at the same pages, so the results are kept
+# in memory (a cache) for a little while and reused.
+#
+# When someone's name changes the cached pages would be wrong, so the routes that change
+# names (callback in login.py and profileEdit in user.py) call clearUserDirectory().
+# Each running copy of the site has its own cache and can only clear its own, so cached
+# pages are also thrown away after CACHE_SECONDS no matter what.
+
+import re
+import time
+from app.classes.data import User, nameKey
+from app.utils.readrouting import readCollection, causalSession
+
+CACHE_SECONDS = 60
+USERS_PER_PAGE = 24
+# Every different search gets its own entry so stop the cache from growing forever.
+MAX_CACHED_PAGES = 1000
+
+# (prefix, page) --> (time it was cached, list of users, is there another page)
+directoryCache = {}
+
+
+def clearUserDirectory():
+    directoryCache.clear()
+
+
+def findUsers(search, page):
+    # the search is normalized the same way as User.namekey
+    prefix = nameKey(search, '')
+    key = (prefix, page)
+
+    cached = directoryCache.get(key)
+    if cached is not None and time.time() - cached[0] < CACHE_SECONDS:
+        return cached[1], cached[2]
+
+    query = {}
+    if prefix:
+        # a regex that starts with ^ can use the namekey index
+        query['namekey'] = {'$regex': '^' + re.escape(prefix)}
+    fields = {'fname': 1, 'lname': 1, 'role': 1, 'gprofile_pic': 1, 'image': 1}
+    users = readCollection(User).find(query, fields, session=causalSession()).sort('namekey', 1)
+    # get one extra to find out if there is another page
+    users = users.skip((page - 1) * USERS_PER_PAGE).limit(USERS_PER_PAGE + 1)
+
+    # Only plain values are cached, not objects that belong to one request.
+    found = []
+    for user in users:
+        found.append({
+            'id': str(user['_id']),
+            'fname': user.get('fname'),
+            'lname': user.get('lname'),
+            'role': user.get('role'),
+            'gprofile_pic': user.get('gprofile_pic'),
+            # the GridFS id of the image changes when a new one is uploaded so it is
+            # put in the image url and the browser never shows an old picture
+            'imageID': str(user['image']) if user.get('image') else None,
+        })
+    morePages = len(found) > USERS_PER_PAGE
+    found = found[:USERS_PER_PAGE]
+
+    if len(directoryCache) >= MAX_CACHED_PAGES:
+        directoryCache.clear()
+    directoryCache[key] = (time.time(), found, morePages)
+    return found, morePages
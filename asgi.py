@@ -0,0 +1,20 @@
+# This runs the site as an ASGI app so the async routes in app/asyncroutes.py are used:
+#     uvicorn asgi:asgiApp --workers 2
+# The async routes handle the blog and animal pages, their live comment streams and the
+# login callback. Every other path is passed on to the normal Flask app.
+#
+# The Flask routes run one request per thread here, from a pool of about 40 threads.
+# That is why the comment streams, which stay open as long as a page is open, have to be
+# async routes: as Flask routes every open blog or animal page would use up a thread and
+# the rest of the Flask routes would stop answering once the pool was full.
+
+import os
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.routing import Mount
+from app import app
+from app.asyncroutes import asyncRoutes
+
+os.environ['OAUTHLIB_RELAX_TOKEN_SCOPE'] = '1'
+
+asgiApp = Starlette(routes=asyncRoutes + [Mount('/', app=WSGIMiddleware(app))])
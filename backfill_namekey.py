@@ -0,0 +1,31 @@
+# Users saved before User.namekey was added don't have one, so the /users directory
+# can't find them. Run this once after deploying to give them one:
+#
+#     python backfill_namekey.py
+#
+# It only touches users that are missing namekey, so running it again is harmless.
+
+from pymongo import UpdateOne
+from app.classes.data import User, nameKey
+
+BATCH_SIZE = 500
+
+
+def backfillNameKeys():
+    users = User._get_collection()
+    missing = users.find({'namekey': {'$exists': False}}, {'fname': 1, 'lname': 1})
+    updates = []
+    total = 0
+    for user in missing:
+        # the same value User.clean() would set
+        updates.append(UpdateOne({'_id': user['_id']}, {'$set': {'namekey': nameKey(user.get('fname'), user.get('lname'))}}))
+        if len(updates) == BATCH_SIZE:
+            total += users.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        total += users.bulk_write(updates, ordered=False).modified_count
+    return total
+
+
+if __name__ == '__main__':
+    print('{} users were given a namekey.'.format(backfillNameKeys()))
@@ -0,0 +1,74 @@
+# This compares the normal Flask routes with the async routes in app/asyncroutes.py by
+# sending lots of requests at the same time to both and timing them.
+#
+# 1) start the sync site:   gunicorn -w 4 -b 127.0.0.1:8000 main:app
+#    (note: --worker-class sync, not gunicorn.conf.py, so you are measuring plain threads)
+# 2) start the async site:  uvicorn asgi:asgiApp --workers 4 --port 8001
+# 3) log in to either one in a browser and copy the value of the 'session' cookie
+# 4) python benchmark.py --cookie <session cookie> --path /blogs --path /blog/<a blog id>
+#
+# Both sites have to use the same FLASK_SECRET_KEY so the same cookie works on both.
+
+import argparse
+import asyncio
+import statistics
+import time
+import httpx
+
+
+async def hammer(baseURL, path, cookie, total, concurrency):
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker(http):
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                response = await http.get(path)
+                if response.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=baseURL, cookies={'session': cookie}, limits=limits, timeout=60, verify=False) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(http) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def report(name, latencies, errors, elapsed):
+    if not latencies:
+        print('{:6} every request failed ({} errors)'.format(name, errors))
+        return
+    latencies.sort()
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print('{:6} {:8.1f} req/s   p50 {:7.1f} ms   p95 {:7.1f} ms   p99 {:7.1f} ms   mean {:7.1f} ms   errors {}'.format(
+        name, len(latencies) / elapsed, percentile(0.50), percentile(0.95), percentile(0.99),
+        statistics.mean(latencies) * 1000, errors))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Compare the sync and async routes under load.')
+    parser.add_argument('--sync', default='http://127.0.0.1:8000', help='url of the Flask (WSGI) site')
+    parser.add_argument('--async', dest='asyncURL', default='http://127.0.0.1:8001', help='url of the asgi.py site')
+    parser.add_argument('--path', action='append', help='page to request, can be given more than once (default /blogs)')
+    parser.add_argument('--cookie', required=True, help="value of the 'session' cookie of a logged in user")
+    parser.add_argument('--requests', type=int, default=2000, help='requests per page per site')
+    parser.add_argument('--concurrency', type=int, default=200, help='requests in flight at once')
+    args = parser.parse_args()
+
+    for path in args.path or ['/blogs']:
+        print('{}  ({} requests, {} at a time)'.format(path, args.requests, args.concurrency))
+        for name, baseURL in (('sync', args.sync), ('async', args.asyncURL)):
+            report(name, *await hammer(baseURL, path, args.cookie, args.requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
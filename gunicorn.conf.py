@@ -0,0 +1,9 @@
+# Settings for running the site with gunicorn:
+#     gunicorn -c gunicorn.conf.py main:app
+# The gevent worker lets one worker hold many open connections at once. That matters for
+# the live comment streams (/blog/<blogID>/stream and /animal/<animalID>/stream) which
+# stay open for as long as someone is looking at the page.
+
+worker_class = 'gevent'
+worker_connections = 1000
+workers = 2